@@ -53,12 +53,22 @@ import threading
 import time
 import zlib
 
-from StringIO import StringIO
+from io import BytesIO
 from base64 import urlsafe_b64encode
+try:
+    from base64 import encodebytes as _b64encode_lines
+except ImportError:
+    from base64 import encodestring as _b64encode_lines
 from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.backends import default_backend
 
 
+_MESSAGE_PARSER = email.parser.Parser()
+_FETCH_UID_RE = re.compile(r'\bUID (\d+)')
+_METADATA_PADDING = '_' * 148
+_DATA_PADDING = ' ' * 2048
+
+
 def _clean_path(path):
     while path[:1] == '/':
         path = path[1:]
@@ -67,6 +77,31 @@ def _clean_path(path):
     return path.replace('//', '/')
 
 
+def _extract_xmailfile(data):
+    """
+    Extract the X-Mailfile header from raw message headers, without parsing
+    the whole message. The header is base64, so all whitespace is removed.
+    """
+    lowered = data.lower()
+    if lowered.startswith('x-mailfile:'):
+        start = 11
+    else:
+        start = lowered.find('\nx-mailfile:')
+        if start < 0:
+            raise KeyError('Missing header: X-Mailfile')
+        start += 12
+    end = start
+    while True:
+        eol = data.find('\n', end)
+        if eol < 0:
+            end = len(data)
+            break
+        end = eol + 1
+        if data[end:end+1] not in (' ', '\t'):
+            break
+    return ''.join(data[start:end].split())
+
+
 def _clean_metadata(metadata):
     for k in ('_', 'fn'):
         if k in metadata:
@@ -74,9 +109,9 @@ def _clean_metadata(metadata):
     return metadata
 
 
-class Mailfile_File(StringIO):
+class Mailfile_File(BytesIO):
     """
-    This class presents a file-like interface (based on StringIO) to a file
+    This class presents a file-like interface (based on BytesIO) to a file
     stored in Mailfile.
 
     All operations are in RAM until the file is closed, at which point (if
@@ -95,13 +130,14 @@ class Mailfile_File(StringIO):
     integer informing Mailfile how many backups to keep of this file before
     garbage collection.
     """
-    def __init__(self, mailfile, file_path, mode, metadata, *args, **kwargs):
-        StringIO.__init__(self, *args, **kwargs)
+    def __init__(self, mailfile, file_path, mode, metadata, contents=b''):
+        BytesIO.__init__(self, contents)
         self._file_path = file_path
         self._open_mode = mode
         self._mailfile = mailfile
         self._lock = mailfile._lock
         self._metadata = metadata
+        self._size = len(contents)
 
     file_path = property(lambda self: self._file_path)
     metadata = property(lambda self: self._metadata)
@@ -115,11 +151,22 @@ class Mailfile_File(StringIO):
         self._lock.release()
 
     def __len__(self):
-        p0 = self.tell()
-        self.seek(0, mode=2)
-        p2 = self.tell()
-        self.seek(p0)
-        return p2
+        return self._size
+
+    def write(self, data):
+        written = BytesIO.write(self, data)
+        if written:
+            self._size = max(self._size, self.tell())
+        return written
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def truncate(self, *args, **kwargs):
+        size = BytesIO.truncate(self, *args, **kwargs)
+        self._size = min(self._size, size)
+        return size
 
     def close(self, *args, **kwargs):
         if 'w' in self._open_mode or 'a' in self._open_mode:
@@ -127,7 +174,7 @@ class Mailfile_File(StringIO):
             self._mailfile._set_file(self)
             self._mailfile = None  # Break reference cycle
         else:
-            StringIO.close(self, *args, **kwargs)
+            BytesIO.close(self, *args, **kwargs)
 
 
 class Mailfile_Config(object):
@@ -180,17 +227,25 @@ class Mailfile_Config(object):
 
 class Mailfile(object):
     _SNAPSHOT_FILE_PATH = 'Mailfile/metadata'
+    _FETCH_BATCH_SIZE = 500
 
-    def __init__(self, imap_obj, base_folder='FILE_STORAGE', **kwargs):
+    def __init__(self, imap_obj, base_folder='FILE_STORAGE', imap_pool=None,
+                 **kwargs):
         self.config = Mailfile_Config(**kwargs)
         self.imap = imap_obj
+        self.imap_pool = list(imap_pool or [])
         self._base_folder = base_folder
         self._lock = threading.RLock()
         self._sstack = []
         self._unwritten = {}
+        self._unwritten_sizes = {}
         self._unwritten_bytes = 0
         self._tree = {}
         self._seen = set([])
+        self._broken = set([])
+        self._broken_key = None
+        self._uidvalidity = None
+        self._sync_state = None
 
     def __enter__(self, *args, **kwargs):
         """
@@ -223,9 +278,14 @@ class Mailfile(object):
 
         The synchronization protocol is as follows; it depends on messages
         in an IMAP folder receiving ascending, never-repeated integer IDs.
+        If the server reports a new UIDVALIDITY, the IDs have been reset and
+        our index is rebuilt from scratch. If the server reports the same
+        message count, UIDNEXT and UIDVALIDITY as last time, the folder has
+        not changed and there is nothing to do (unless cleaning up).
 
         1. Messages in Mailfile are read and parsed in reverse order:
-           1. If we cannot parse or decrypt the message, ignore it.
+           1. If we cannot parse or decrypt the message, ignore it (and
+              do not try again, unless the encryption key changes).
            2. If we have seen and processed this message before, stop.
            3. File objects: If a message represents a new file or a NEWER
               version of one we've already seen, update our file index.
@@ -234,11 +294,32 @@ class Mailfile(object):
         """
         with self._lock:
             self.flush()
-            if 'OK' != self.imap.select(self._base_folder)[0]:
-                if ('OK' != self.imap.create(self._base_folder)[0] or
-                        'OK' != self.imap.select(self._base_folder)[0]):
+            selected = self.imap.select(self._base_folder)
+            if 'OK' != selected[0]:
+                if 'OK' == self.imap.create(self._base_folder)[0]:
+                    selected = self.imap.select(self._base_folder)
+                if 'OK' != selected[0]:
                     raise IOError('Could not select: %s' % self._base_folder)
 
+            uidvalidity = self._imap_response('UIDVALIDITY')
+            if None not in (uidvalidity, self._uidvalidity) and (
+                    uidvalidity != self._uidvalidity):
+                self._tree = {}
+                self._seen = set([])
+                self._broken = set([])
+            self._uidvalidity = uidvalidity or self._uidvalidity
+
+            if self._broken_key != self.config.key:
+                self._broken = set([])
+                self._broken_key = self.config.key
+
+            uidnext = self._imap_response('UIDNEXT')
+            sync_state = (
+                selected[1][0], uidnext, uidvalidity, self.config.key)
+            if (uidnext is not None and sync_state == self._sync_state
+                    and not (cleanup or snapshot or self._unwritten)):
+                return
+
             (rv, (seqs,)) = self.imap.uid('SEARCH', 'ALL')
             if rv != 'OK':
                 raise IOError(
@@ -246,34 +327,50 @@ class Mailfile(object):
                     % (self._base_folder, rv, seqs))
 
             distance = 0
-            seqs = sorted([int(i) for i in seqs.split(' ') if i])
+            # Servers return ascending UIDs, in which case sorting is a
+            # single linear pass; we sort anyway to be safe.
+            seqs = list(map(int, seqs.split()))
+            seqs.sort()
             existing = set(seqs)
             broken = set([])
             to_delete = set([])
+
+            unseen = []
             for seq in reversed(seqs):
                 if seq in self._seen:
                     break
+                if seq not in self._broken:
+                    unseen.append(seq)
+
+            fetched = {}
+            for i, seq in enumerate(unseen):
+                if seq in self._seen:
+                    break
+                if i % self._FETCH_BATCH_SIZE == 0:
+                    fetched = self._fetch_headers(
+                        unseen[i:i + self._FETCH_BATCH_SIZE])
+                if seq not in fetched:
+                    broken.add(seq)
+                    continue
                 try:
-                    (rv, data) = self.imap.uid(
-                        'FETCH', str(seq), '(BODY.PEEK[]<0.1024>)')
-                    if rv != 'OK':
-                        broken.add(seq)
-                        continue
-                    metadata = self._parse_message(
-                        None, data[0][1], headersonly=True, clean=False)
+                    metadata = self._parse_metadata(
+                        None, _extract_xmailfile(fetched[seq]),
+                        clean=False)
                     file_path = metadata['fn']
                     self._seen.add(seq)
                     distance += 1
-                except (ValueError, NameError, AttributeError, KeyError,
-                        IndexError, InvalidToken):
+                except (ValueError, TypeError, NameError, AttributeError,
+                        KeyError, IndexError, InvalidToken):
                     broken.add(seq)
+                    self._broken.add(seq)
                     continue
 
-                if self._tree.get(file_path, (-1,))[0] < seq:
+                latest = self._tree.get(file_path)
+                if latest is None or latest[0] < seq:
                     _clean_metadata(metadata)
                     versions = set([seq])
-                    if file_path in self._tree:
-                        versions |= self._tree[file_path][2]
+                    if latest is not None:
+                        versions |= latest[2]
                     self._tree[file_path] = (seq, metadata, versions)
                     if file_path == self._SNAPSHOT_FILE_PATH and not ignore_snapshot:
                         try:
@@ -307,9 +404,47 @@ class Mailfile(object):
                         self._seen -= set(to_delete)
 
             self._seen &= existing
+            self._broken &= existing
+            # Messages the server did not return will be retried, so the
+            # next synchronization must not be skipped.
+            if broken - self._broken:
+                self._sync_state = None
+            else:
+                self._sync_state = sync_state
             if (snapshot is not False) and (distance > 20 or snapshot is True):
                 self.save_snapshot()
 
+    def _imap_response(self, code):
+        try:
+            return self.imap.response(code)[1][-1]
+        except (TypeError, IndexError, AttributeError):
+            return None
+
+    def _fetch_headers(self, seqs):
+        """
+        Fetch the X-Mailfile headers of many messages using a single UID
+        FETCH, returning a dict mapping UIDs to header data. Messages the
+        server did not return are missing from the result.
+        """
+        (rv, data) = self.imap.uid(
+            'FETCH', ','.join('%d' % s for s in seqs),
+            '(BODY.PEEK[HEADER.FIELDS (X-Mailfile)])')
+        if rv != 'OK':
+            return {}
+        results, pending = {}, None
+        for item in data:
+            if isinstance(item, tuple):
+                envelope, pending = item
+            else:
+                envelope = item or ''
+            # Servers usually put the UID before the literal, but may also
+            # send it afterwards, as part of the closing line.
+            match = _FETCH_UID_RE.search(envelope)
+            if match and pending is not None:
+                results[int(match.group(1))] = pending
+                pending = None
+        return results
+
     def save_snapshot(self):
         """
         Save a snapshot of the current metadata index back to IMAP.
@@ -345,14 +480,14 @@ class Mailfile(object):
         return data
 
     def _reflow(self, data, indent='', linelen=78, preserve=False):
+        sep = '\r\n' + indent
         if preserve:
-            return indent + data.replace('\n', '\r\n' + indent).strip()
+            return indent + data.replace('\n', sep).strip()
         else:
-            linelen -= len(indent)
-            return indent + re.sub(
-                '(\S{%d,%d})' % (linelen, linelen),
-                lambda m: m.group(0)+'\r\n'+indent,
-                ''.join(data.split())).strip()
+            data = ''.join(data.split())
+            step = linelen - len(indent)
+            return indent + sep.join(
+                data[i:i+step] for i in range(0, len(data), step))
 
     def encode_object(self, file_path, file_data, metadata=None):
         """
@@ -386,7 +521,8 @@ class Mailfile(object):
         if metadata:
             mdata.update(metadata)
         mdata.update({'fn': file_path, 'bytes': len(file_data)})
-        xmailfile = json.dumps(mdata, indent=1).strip()
+        mdata.pop('_', None)
+        xmailfile = json.dumps(mdata, indent=1)
 
         if self.config.encrypt:
             # Note: The padding numbers, 148 and 2048, are chosen in part to
@@ -395,14 +531,18 @@ class Mailfile(object):
             encoding = '7bit'
             subject = self.config.subject
             filename = 'mailfile.enc'
-            padding = ('_' * 200)
-            mdata['_'] = padding[:148 - (len(xmailfile) % 148)]
-            xmailfile = json.dumps(mdata, indent=1)
-            file_data += (' ' * (2048 - (len(file_data) % 2048)))
+            # Append the `_` padding attribute to the already serialized
+            # JSON, instead of encoding everything a second time.
+            xmailfile = '%s,\n "_": "%s"\n}' % (
+                xmailfile[:-2],
+                _METADATA_PADDING[:148 - (len(xmailfile) % 148)])
+            file_data += _DATA_PADDING[:2048 - (len(file_data) & 2047)]
+            body = self._reflow(self._maybe_encrypt(file_data))
         else:
             encoding = 'base64'
             subject = '%s: %s' % (self.config.subject, file_path)
             filename = os.path.basename(file_path)
+            body = _b64encode_lines(file_data).replace('\n', '\r\n')
 
         return '\r\n'.join([
             'To: %s' % self.config.email_to,
@@ -417,7 +557,7 @@ class Mailfile(object):
             'Content-Transfer-Encoding: %s' % encoding,
             'Content-Disposition: attachment; filename="%s"' % filename,
             '',
-            self._reflow(self._maybe_encrypt(file_data, b64encode=True))])
+            body])
 
     def set_encryption_key(self, key):
         """
@@ -428,28 +568,65 @@ class Mailfile(object):
         size before use. Please use `cryptography.fernet.Fernet.generate_key`
         or something of equivalent strength to generate strong keys.
         """
-        self.config.key = urlsafe_b64encode(hashlib.sha256(key).digest()[:32])
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        self.config.key = urlsafe_b64encode(hashlib.sha256(key).digest())
         self.config.fernet = Fernet(self.config.key)
         self.config.encrypt = True
 
+    def _append(self, imap, file_path, fobj):
+        eml = self.encode_object(
+            file_path, fobj.getvalue(), metadata=fobj.metadata)
+        (rv, d) = imap.append(self._base_folder, None, None, eml)
+        return (file_path, rv == 'OK')
+
     def flush(self):
         """
         Write any buffered changes to the remote server. This gets called
         automatically when exiting a `with mailfile ...` block. Returns True
         upon success, False if there was a problem writing to the server.
+
+        If the Mailfile was created with an `imap_pool` of additional
+        (logged in) IMAP connections, multiple files will be uploaded in
+        parallel, one per connection.
         """
         happy = True
         with self._lock:
-            for file_path in self._unwritten.keys():
-                fobj = self._unwritten[file_path]
-                eml = self.encode_object(
-                    file_path, fobj.getvalue(), metadata=fobj.metadata)
-                (rv, d) = self.imap.append(self._base_folder, None, None, eml)
-                if rv == 'OK':
-                    self._unwritten_bytes -= len(self._unwritten[file_path])
+            pending = list(reversed(list(self._unwritten.items())))
+            connections = [self.imap] + self.imap_pool
+            results, errors = [], []
+
+            def _worker(imap):
+                while True:
+                    try:
+                        file_path, fobj = pending.pop()
+                    except IndexError:
+                        return
+                    try:
+                        results.append(self._append(imap, file_path, fobj))
+                    except Exception as e:
+                        errors.append(e)
+                        return
+
+            if len(pending) < 2 or len(connections) < 2:
+                _worker(self.imap)
+            else:
+                threads = [threading.Thread(target=_worker, args=(imap,))
+                           for imap in connections[:len(pending)]]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+            for file_path, ok in results:
+                if ok:
                     del self._unwritten[file_path]
+                    self._unwritten_bytes -= (
+                        self._unwritten_sizes.pop(file_path))
                 else:
                     happy = False
+            if errors:
+                raise errors[0]
         return happy
 
     def _maybe_flush(self):
@@ -459,18 +636,15 @@ class Mailfile(object):
 
     def _set_file(self, file_obj):
         with self._lock:
-            self._unwritten[file_obj.file_path] = file_obj
-            self._unwritten_bytes += len(file_obj)
+            file_path = file_obj.file_path
+            self._unwritten_bytes -= self._unwritten_sizes.get(file_path, 0)
+            self._unwritten[file_path] = file_obj
+            self._unwritten_sizes[file_path] = len(file_obj)
+            self._unwritten_bytes += self._unwritten_sizes[file_path]
             self._maybe_flush()
 
-    def _parse_message(self, file_path, data, headersonly=False, clean=True):
-        if headersonly:
-            parser = email.parser.HeaderParser()
-        else:
-            parser = email.parser.Parser()
-        message = parser.parsestr(data, headersonly=headersonly)
-
-        xmailfile = message['X-Mailfile'].strip()
+    def _parse_metadata(self, file_path, xmailfile, clean=True):
+        xmailfile = xmailfile.strip()
         if xmailfile[:1] == '!':
             xmailfile = self.config.fernet.decrypt(xmailfile[1:])
         else:
@@ -483,8 +657,12 @@ class Mailfile(object):
         if clean:
             _clean_metadata(metadata)
 
-        if headersonly:
-            return metadata
+        return metadata
+
+    def _parse_message(self, file_path, data, clean=True):
+        message = _MESSAGE_PARSER.parsestr(data)
+        metadata = self._parse_metadata(
+            file_path, message['X-Mailfile'], clean=clean)
 
         for part in message.walk():
             if part.get_content_type() == 'application/x-mailfile':
@@ -556,6 +734,7 @@ class Mailfile(object):
         file_path = _clean_path(file_path)
         with self._lock:
             if file_path in self._unwritten:
+                self._unwritten_bytes -= self._unwritten_sizes.pop(file_path)
                 del self._unwritten[file_path]
 
             finfo = self._tree.get(file_path)
@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with Mailfile. If not, see <https://www.gnu.org/licenses/>.
 #
+import errno
 import os
 import sys
 import threading
@@ -74,19 +75,29 @@ class FilesystemIMAP(object):
                     seq = max(files.keys()) + 1
                 else:
                     seq = 1
-                newfn = self._fn_fmt(seq, flags)
+                # Other connections may be appending to the same folder, so
+                # never overwrite: bump the sequence number until we manage
+                # to create a new file.
+                while True:
+                    newfn = self._fn_fmt(seq, flags)
+                    try:
+                        fno = os.open(os.path.join(mpath, 'cur', newfn),
+                                      os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                      0o666)
+                        break
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                        seq += 1
                 files[seq] = newfn
-                with open(os.path.join(mpath, 'cur', newfn), 'w') as fd:
+                with os.fdopen(fno, 'w') as fd:
                     fd.write(message.replace('\r\n', '\n'))
                 return _l('APPEND', ('OK', ['APPEND completed: %8.8x' % seq]))
         except (IOError, OSError, ValueError, KeyError, IndexError) as e:
             return _l('APPEND', ('NO', ['APPEND failed: %s' % e]))
 
     def response(self, code):
-        rv = self.response_data.get(code)
-        if code in self.response_data:
-            del self.response_data[code]
-        return rv
+        return code, self.response_data.pop(code, [None])
 
     def uid(self, command, *args):
         if command == 'SEARCH':
@@ -127,7 +138,7 @@ class FilesystemIMAP(object):
                 if c and c != 'ALL':
                     raise ValueError('I am not very good at searching')
             with self.lock:
-                seqs = self._list(self._path(self.selected)).keys()
+                seqs = sorted(self._list(self._path(self.selected)).keys())
                 return _l('SEARCH', ('OK', [' '.join('%d' % s for s in seqs)]))
         except (IOError, OSError, ValueError, KeyError, IndexError) as e:
             return _l('SEARCH', ('NO', ['Search failed: %s' % e]))
@@ -151,20 +162,59 @@ class FilesystemIMAP(object):
             'STORE %s %s %s' % (message_set, command, flags),
             ('OK', [message_set]))
 
+    def _message_set(self, message_set, files):
+        for part in message_set.split(','):
+            if ':' in part:
+                first, last = part.split(':')
+                last = max(files.keys() or [0]) if (last == '*') else int(last)
+                for seq in sorted(files.keys()):
+                    if int(first) <= seq <= last:
+                        yield seq
+            else:
+                yield int(part)
+
+    def _fetch_part(self, data, message_parts):
+        if 'HEADER' in message_parts:
+            data = data[:data.find('\r\n\r\n') + 2]
+            if 'HEADER.FIELDS' in message_parts:
+                fields = message_parts.split('FIELDS (')[1].split(')')[0]
+                fields = [f.lower() + ':' for f in fields.split()]
+                lines, keep = [], False
+                for line in data.split('\r\n')[:-1]:
+                    if line[:1] not in (' ', '\t'):
+                        keep = (line.split(':')[0].lower() + ':') in fields
+                    if keep:
+                        lines.append(line + '\r\n')
+                data = ''.join(lines)
+            return data + '\r\n'
+        return data
+
     def fetch(self, message_set, message_parts):
         try:
-            seq = int(message_set)
             mpath = self._path(self.selected)
             files = self._list(mpath)
-            for sub in ('cur', 'new'):
-                fn = os.path.join(mpath, sub, files[seq])
-                data = open(fn, 'rb').read().replace('\n', '\r\n')
-                return _l(
-                    'FETCH %s %s' % (message_set, message_parts),
-                    ('OK', [['', data]]))
+            results = []
+            for seq in self._message_set(message_set, files):
+                if seq not in files:
+                    continue
+                for sub in ('cur', 'new'):
+                    fn = os.path.join(mpath, sub, files[seq])
+                    if os.path.exists(fn):
+                        data = self._fetch_part(
+                            open(fn, 'rb').read().replace('\n', '\r\n'),
+                            message_parts)
+                        results.append(('%d (UID %d %s {%d}' % (
+                            seq, seq, message_parts.strip('()'), len(data)),
+                            data))
+                        results.append(')')
+                        break
+            if not results:
+                raise KeyError('No such message(s): %s' % message_set)
+            return _l(
+                'FETCH %s %s' % (message_set, message_parts),
+                ('OK', results))
         except (IOError, OSError, ValueError, KeyError, IndexError) as e:
-            pass
-        return _l('FETCH', ('NO', ['Fetch failed: %s' % e]))
+            return _l('FETCH', ('NO', ['Fetch failed: %s' % e]))
 
     def close(self): return _l('CLOSE', ('OK', ['This is a noop']))
     def logout(self): return _l('LOGOUT', ('OK', ['This is a noop']))
@@ -25,6 +25,7 @@ import hashlib
 import imaplib
 import json
 import os
+import shutil
 import sys
 
 from . import Mailfile
@@ -50,6 +51,12 @@ def _load_creds():
         return None
 
 
+def _save_creds(creds):
+    with open(_loginfile(), 'w') as fd:
+        os.chmod(_loginfile(), 0o600)
+        fd.write(base64.b64encode(json.dumps(creds).encode('utf-8')).decode())
+
+
 def _get_mailfile(creds=None):
     if creds is None:
         creds = _load_creds()
@@ -107,10 +114,12 @@ The last argument should be the destination directory."""
                 dest_fn = os.path.join(dest, os.path.basename(fn))
             else:
                 dest_fn = os.path.basename(fn)
-            with open(fn, 'r') as fd:
-                data = fd.read()
-            with mailfile.open(dest_fn, 'w') as fd:
-                fd.write(data)
+            with open(fn, 'rb') as fd:
+                # Only close (and thus save) the file if the copy succeeded,
+                # so a failed read cannot replace it with partial data.
+                mf_fd = mailfile.open(dest_fn, 'w')
+                shutil.copyfileobj(fd, mf_fd, 65536)
+                mf_fd.close()
             if '--verbose' in opts or '-v' in opts:
                 print("%s -> mailfile:%s" % (fn, dest_fn))
     return True
@@ -147,13 +156,6 @@ specific version, it doesn't make sense to request multiple files."""
             target = os.path.join(dest_dir, os.path.basename(fn))
         return target
 
-    def _pmkdir(fn):
-        dn = os.path.dirname(fn)
-        if not os.path.exists(dn):
-            if dn and fn != dn:
-                _pmkdir(dn)
-                os.mkdir(dn)
-
     opts = dict(opts)
     if '--recurse' in opts or '-r' in opts:
         full_path = True
@@ -180,10 +182,12 @@ specific version, it doesn't make sense to request multiple files."""
             while fn[:1] == '/':
                 fn = fn[1:]
             target = _fn(fn)
-            if full_path:
-                _pmkdir(target)
-            data = mailfile.open(fn, 'r', version=version).read()
-            open(target, 'w').write(data)
+            target_dir = os.path.dirname(target)
+            if full_path and target_dir and not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+            with mailfile.open(fn, 'r', version=version) as mf_fd:
+                with open(target, 'wb') as fd:
+                    shutil.copyfileobj(mf_fd, fd, 65536)
             if '--verbose' in opts or '-v' in opts:
                 print("mailfile:%s -> %s" % (fn, target))
     return True
@@ -319,9 +323,7 @@ hand if you want them gone too.
 """
     creds = _load_creds()
     del creds['password']
-    with open(_loginfile(), 'w') as fd:
-        os.chmod(_loginfile(), 0o600)
-        fd.write(base64.encodestring(json.dumps(creds)))
+    _save_creds(creds)
     sys.stderr.write('OK: Deleted password from %s\n' % _loginfile())
     return True
 
@@ -363,9 +365,7 @@ delete the IMAP password from this file."""
 
     _get_mailfile(creds).synchronize()
 
-    with open(_loginfile(), 'w') as fd:
-        os.chmod(_loginfile(), 0o600)
-        fd.write(base64.encodestring(json.dumps(creds)))
+    _save_creds(creds)
     return True
 
 